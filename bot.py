@@ -1,53 +1,199 @@
 from interactions import Client, Intents, slash_command, SlashContext, listen, slash_option, OptionType
+from interactions import Embed, EMBED_MAX_DESC_LENGTH, EMBED_MAX_FIELDS, EMBED_FIELD_VALUE_LENGTH, EMBED_TOTAL_MAX
 from dotenv import load_dotenv
 import os
+import asyncio
+import atexit
 import logging
-from querying import data_querying, detect_academic_dishonesty, generate_quiz
-from manage_embedding import update_index
+import logging.handlers
+import queue
+import re
+import signal
+import sys
+import time
+import ahocorasick
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None
+from querying import data_querying_stream, retrieve_context, parse_guarded_answer, may_be_refusal, generate_quiz, warm_up
+from manage_embedding import update_index, on_index_change
+from semantic_cache import SemanticCache
+from embedding_cache import get_embedding
 
 # Suppress noisy warnings from the interactions library
 logging.getLogger("interactions").setLevel(logging.ERROR)
 
+# Write log output from a background thread so the event loop never blocks on stdout
+log_queue = queue.SimpleQueue()
+root_logger = logging.getLogger()
+log_listener = logging.handlers.QueueListener(log_queue, *root_logger.handlers, respect_handler_level=True)
+root_logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+log_listener.start()
+atexit.register(log_listener.stop)
+
+log = logging.getLogger("eduebot.moderation")
+
 load_dotenv()  # load env file
 
 # Initialise bot with all intents (maybe reduce in future)
 bot = Client(intents=Intents.ALL)
 
+# Cache of /ask answers so repeated or near-identical questions skip the RAG pipeline.
+# Saved to disk periodically and on exit so the cache survives restarts
+ask_cache = SemanticCache(get_embedding, path=os.getenv("ASK_CACHE_PATH", ".ask_cache.json"))
+atexit.register(ask_cache.save)
+
+# Same for /quiz, kept separate from /ask and stricter, since a quiz on the wrong topic is worse than a loose answer
+quiz_cache = SemanticCache(get_embedding, threshold=0.97, path=os.getenv("QUIZ_CACHE_PATH", ".quiz_cache.json"))
+atexit.register(quiz_cache.save)
+
+# Seconds between background saves of the answer caches (so a crash loses at most this much)
+CACHE_SAVE_INTERVAL = int(os.getenv("CACHE_SAVE_INTERVAL", "300"))
+cache_save_task = None
+
+@on_index_change
+def clear_answer_caches():
+    """
+    Drops every cached answer and quiz whenever the index is rebuilt or its documents change.
+    """
+    ask_cache.clear()
+    quiz_cache.clear()
+
+# Seconds between edits while streaming an answer (Discord rate-limits message edits)
+STREAM_EDIT_INTERVAL = 0.5
+
+# Longest plain message Discord accepts; longer replies go in an embed (see send_long)
+DISCORD_MESSAGE_LIMIT = 2000
+
+# Shortest piece send_long splits a long reply into: no embed field is started with less room than this left,
+# and the last piece isn't left shorter than this (no stray 3-character follow-up message)
+MIN_PIECE_LENGTH = 200
+
+# Moderation actions run as background tasks (kept here so they aren't garbage collected),
+# limited per channel so a flood of profanity doesn't hit Discord's rate limits.
+# A channel's semaphore only exists while it has moderation tasks, so idle channels don't pile up
+MODERATION_CONCURRENCY = 4
+moderation_tasks = set()
+moderation_semaphores = {}  # channel id -> [semaphore, number of tasks using it]
+
 # Word list loader
 def load_wordlist(filename):
     """
-    Helper: loads a list of words from file into a set.
+    Helper: loads a list of words from file into a frozenset.
+    The file is read and lowercased in one go rather than line by line.
     """
     try:
         with open(filename,"r") as f:
-            return {line.strip().lower() for line in f if line.strip()}
+            lines = f.read().lower().splitlines()
+        return frozenset(line.strip() for line in lines if line.strip())
     except FileNotFoundError:
         print(f"ERROR: {filename} not found. Treating as empty.")
-        return set()
+        return frozenset()
 
 blacklist = load_wordlist("blacklist.txt")
 
 whitelist = load_wordlist("whitelist.txt")
-sorted_whitelist = sorted(list(whitelist),key=len,reverse=True)  # sort whitelist by length descending so that longer words (class) whitelisted before "ass" is blacklisted
+
+# Quick pre-filter: messages shorter than the shortest blacklisted word can't be profane,
+# and neither can messages without letters (as long as every blacklisted word has one)
+MIN_BLACKLIST_WORD_LEN = min((len(word) for word in blacklist), default=0)
+LETTER_RE = re.compile(r"[a-z]", re.IGNORECASE)
+BLACKLIST_NEEDS_LETTERS = all(LETTER_RE.search(word) for word in blacklist)
+
+# Word lists at least this long (combined) are matched with Hyperscan instead of Aho-Corasick, if it's installed
+HYPERSCAN_MIN_WORDS = 1000
+
+def build_automaton_scanner(words):
+    """
+    Helper: builds an Aho-Corasick automaton over a collection of words.
+    Returns a function giving the (start, end) span of every word found in a text.
+    """
+    if not words:
+        return lambda text: []
+    automaton = ahocorasick.Automaton()
+    for word in words:
+        automaton.add_word(word, word)
+    automaton.make_automaton()
+    return lambda text: ((end - len(word) + 1, end) for end, word in automaton.iter(text))
+
+def build_hyperscan_scanner(words):
+    """
+    Helper: same as build_automaton_scanner, but compiles the words into a Hyperscan database (a SIMD-accelerated DFA).
+    Spans are byte offsets into the UTF-8 encoded text.
+    """
+    if not words:
+        return lambda text: []
+    words = list(words)
+    lengths = [len(word.encode()) for word in words]
+    database = hyperscan.Database()
+    database.compile(
+        expressions=[re.escape(word).encode() for word in words],
+        ids=list(range(len(words))),
+        elements=len(words),
+    )
+
+    def scan(text):
+        spans = []
+        def on_match(word_id, start, end, flags, context):
+            spans.append((end - lengths[word_id], end - 1))
+        database.scan(text.encode(), match_event_handler=on_match)
+        return spans
+    return scan
+
+# Built once at import time so each message is checked in a single linear scan.
+# Hyperscan (optional, `pip install hyperscan`) only pays off once the word lists get very large
+use_hyperscan = hyperscan is not None and len(blacklist) + len(whitelist) >= HYPERSCAN_MIN_WORDS
+build_scanner = build_hyperscan_scanner if use_hyperscan else build_automaton_scanner
+find_blacklisted = build_scanner(blacklist)
+find_whitelisted = build_scanner(whitelist)
 
 def is_profane(text:str) -> bool:
     """
     Checker: Is inputted string on "blacklist.txt"?
-    Whitelisted words are removed from the text before the check is conducted.
+    Blacklisted words that sit entirely inside a whitelisted word (e.g. "ass" in "class") are ignored.
     """
     text = text.lower()
+    whitelisted_spans = None
 
-    # remove whitelisted words
-    for word in sorted_whitelist:
-        cleaned_text = cleaned_text.replace(word,"")
-    
-    # check for blacklisted words
-    return any(bad_word in cleaned_text for bad_word in blacklist)
+    # check for blacklisted words, returning on the first one not covered by the whitelist
+    for start, end in find_blacklisted(text):
+        # only look for whitelisted words once a blacklisted one turns up (most messages have none)
+        if whitelisted_spans is None:
+            whitelisted_spans = list(find_whitelisted(text))
+
+        if not any(w_start <= start and end <= w_end for w_start, w_end in whitelisted_spans):
+            return True
+    return False
 
 # ---------------- EVENT LISTENERS ----------------
 @listen() 
 async def on_ready():
     print("Ready")
+
+@listen()
+async def on_startup():
+    """
+    Called once, the first time the bot is ready.
+    Builds the heavy clients up front so every command can defer within Discord's 3s window.
+    """
+    global cache_save_task
+    cache_save_task = asyncio.create_task(save_caches_periodically())
+
+    await warm_up()
+    print("Warmed up")
+
+async def save_caches_periodically():
+    """
+    Saves the answer caches every CACHE_SAVE_INTERVAL seconds (if they changed), off the event loop.
+    """
+    while True:
+        await asyncio.sleep(CACHE_SAVE_INTERVAL)
+        for cache in (ask_cache, quiz_cache):
+            try:
+                await cache.save_in_background()
+            except OSError as e:
+                print(f"ERROR: Could not save cache {cache.path}: {e}")
  
 @listen()
 async def on_message_create(event):
@@ -60,23 +206,102 @@ async def on_message_create(event):
     if not hasattr(event, "message") or not event.message.content:
         return
 
-    # Store message content and print out
+    # Store message content and log it (debug only - formatting is skipped when debug is off)
     content = event.message.content
-    print(f"READ: Message received: {content}")
+    log.debug("READ: Message received: %s", content)
 
     # ignore messages from bots to prevent loops
     if event.message.author.bot:
         return
 
-    # check for bad words
+    # skip the profanity check for messages that can't contain a blacklisted word
+    if len(content) < MIN_BLACKLIST_WORD_LEN or (BLACKLIST_NEEDS_LETTERS and not LETTER_RE.search(content)):
+        return
+
+    # check for bad words, handing the (slow) Discord API calls to a background task
     if is_profane(content):
-        try:
-            await event_message.delete()
-            print(f"ACTION: Deleted profane message from {event.message.author.username}")
-            # DM user that their message was deleted
-            await event.message.author.send("Your message was removed due to inappropriate language. Please use safe language to keep our learning space suitable for all. Thank you!")
-        except Exception as e:
-            print(f"ERROR: Could not delete message: {e}")
+        task = asyncio.create_task(moderate(event.message))
+        moderation_tasks.add(task)
+        task.add_done_callback(moderation_tasks.discard)
+
+async def moderate(message):
+    """
+    Deletes a profane message and DMs its author.
+    Runs as a background task, at most MODERATION_CONCURRENCY at a time per channel.
+    """
+    channel_id = message.channel.id if message.channel else None
+    entry = moderation_semaphores.get(channel_id)
+    if entry is None:
+        entry = moderation_semaphores[channel_id] = [asyncio.Semaphore(MODERATION_CONCURRENCY), 0]
+    entry[1] += 1
+
+    try:
+        async with entry[0]:
+            try:
+                await message.delete()
+                print(f"ACTION: Deleted profane message from {message.author.username}")
+            except Exception as e:
+                # Don't DM the user about a deletion that didn't happen
+                print(f"ERROR: Could not delete message: {e}")
+                return
+
+            try:
+                # DM user that their message was deleted
+                await message.author.send("Your message was removed due to inappropriate language. Please use safe language to keep our learning space suitable for all. Thank you!")
+            except Exception as e:
+                print(f"ERROR: Could not DM user: {e}")
+    finally:
+        # Drop the channel's semaphore once nothing is using it
+        entry[1] -= 1
+        if not entry[1]:
+            del moderation_semaphores[channel_id]
+
+def split_point(text: str, start: int, limit: int) -> int:
+    """
+    Helper: where the piece of text starting at `start` should end to be at most `limit` characters long.
+    Breaks after a paragraph, line or word if there's one in the second half of the piece, so markdown
+    like **bold** or ||spoilers|| isn't cut in two; only a single huge word is cut mid-way.
+    """
+    if start + limit >= len(text):
+        return len(text)
+    # Leave enough for a useful last piece
+    end = min(start + limit, len(text) - MIN_PIECE_LENGTH)
+    for separator in ("\n\n", "\n", " "):
+        boundary = text.rfind(separator, (start + end) // 2, end)
+        if boundary != -1:
+            return boundary + len(separator)
+    return end
+
+async def send_long(ctx: SlashContext, text: str):
+    """
+    Helper: replies with text that may be longer than one Discord message.
+    Text over the message limit is put in an embed (description plus extra fields, up to 6000 characters),
+    so it still goes out as a single message; only text beyond that spills into follow-up messages.
+    Pieces are split on paragraph, line or word boundaries.
+    """
+    length = len(text)
+    if length <= DISCORD_MESSAGE_LIMIT:
+        await ctx.send(text)
+        return
+
+    # Walk through the text by offset, so each piece is sliced out exactly once
+    start = split_point(text, 0, EMBED_MAX_DESC_LENGTH)
+    embed = Embed(description=text[:start].rstrip())
+    budget = EMBED_TOTAL_MAX - start
+    # Each field needs a (zero-width, 1 character) name, which counts towards the total.
+    # A field with only a few characters of budget left would just be a stray fragment; those go in a follow-up
+    while start < length and budget > MIN_PIECE_LENGTH and len(embed.fields) < EMBED_MAX_FIELDS:
+        end = split_point(text, start, min(EMBED_FIELD_VALUE_LENGTH, budget - 1))
+        embed.add_field(name="\u200b", value=text[start:end].rstrip())
+        budget -= end - start + 1
+        start = end
+
+    # Empty content replaces any partial answer shown while streaming
+    await ctx.send("", embed=embed)
+    while start < length:
+        end = split_point(text, start, DISCORD_MESSAGE_LIMIT)
+        await ctx.send(text[start:end])
+        start = end
 
 # ---------------- SLASH COMMANDS ----------------
 # /ask
@@ -90,26 +315,54 @@ async def on_message_create(event):
 async def get_response(ctx: SlashContext, input_text: str):
     """
     Handles the /ask command. 
-    1. Checks for Academic Integrity (Cheating vs Learning).
-    2. Runs the RAG search if safe.
+    1. Runs the RAG search.
+    2. Checks for Academic Integrity (Cheating vs Learning) in the same LLM call as the answer.
+    Repeated (or very similar) questions reuse the cached verdict and answer.
     """
     await ctx.defer()
 
-    # First check if they are trying to have AI do their homework for them
-    is_safe, warning_msg = await detect_academic_dishonesty(input_text)
-    
+    try:
+        # Reuse the verdict and answer if this (or a very similar) question was handled before
+        # (embedding the question is an API call too, so it can fail like the rest)
+        cached, query_embedding = await ask_cache.lookup(input_text)
+
+        if cached is None:
+            context = await retrieve_context(input_text)
+
+            # Generate the answer, showing it in the reply as it's generated.
+            # The same LLM call checks if they are trying to have AI do their homework for them,
+            # so nothing is shown while the reply could still turn out to be a refusal
+            reply = ""
+            last_edit = time.monotonic()
+            async for delta in data_querying_stream(input_text, context):
+                reply += delta
+                if time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL and not may_be_refusal(reply):
+                    preview = f'**Question:** {input_text}\n\n{reply}'
+                    # (the preview stops growing once it no longer fits in a plain message)
+                    if len(preview) <= DISCORD_MESSAGE_LIMIT:
+                        await ctx.edit(content=preview)
+                    last_edit = time.monotonic()
+    except Exception as e:
+        # Replace any half-finished preview with an error, and don't cache anything
+        print(f"ERROR: Could not answer question: {e}")
+        await ctx.send(f"**Question:** {input_text}\n\nSorry, something went wrong while answering your question. Please try again later.")
+        return
+
+    if cached is not None:
+        is_safe, answer = cached
+    else:
+        is_safe, answer = parse_guarded_answer(reply)
+        ask_cache.insert(input_text, query_embedding, (is_safe, answer))
+
     if not is_safe:
         # If violation, return the warning and stop.
-        response = f"**Sorry, I can't help you with graded assignments. I can do my best to teach you material from your courses.**\n{warning_msg}"
+        response = f"**Sorry, I can't help you with graded assignments. I can do my best to teach you material from your courses.**\n{answer}"
         await ctx.send(response)
         return
 
-    # Call RAG function to search docs, generate answer
-    response = await data_querying(input_text)
-
     # Format output to show user input + bot answer
-    response = f'**Question:** {input_text}\n\n{response}'
-    await ctx.send(response)
+    response = f'**Question:** {input_text}\n\n{answer}'
+    await send_long(ctx, response)
 
 # /quiz
 @slash_command(name="quiz", description="Generate a practice quiz based on a topic!")
@@ -127,10 +380,16 @@ async def create_quiz(ctx: SlashContext, topic: str):
     """
     await ctx.defer()
     
-    quiz_content = await generate_quiz(topic)
+    # Generate a quiz (or reuse one generated for the same/a very similar topic)
+    try:
+        quiz_content = await quiz_cache.get_or_compute(topic.lower().strip(), lambda: generate_quiz(topic))
+    except Exception as e:
+        print(f"ERROR: Could not generate quiz: {e}")
+        await ctx.send(f"**Pop Quiz: {topic}**\n\nSorry, something went wrong while generating your quiz. Please try again later.")
+        return
     
     response = f"**Pop Quiz: {topic}**\n\n{quiz_content}\n\n*Click the black boxes to reveal the answers!*"
-    await ctx.send(response)
+    await send_long(ctx, response)
 
 # /updatedb
 @slash_command(name="updatedb", description="Update your RAG information database")
@@ -143,12 +402,18 @@ async def updated_database(ctx: SlashContext):
 
     # Call update function from manage_embedding.py
     update = await update_index()
-    if update:
+    # An empty list is a successful update where nothing changed
+    # (cached answers are dropped by update_index itself if the documents changed)
+    if update is not None:
         response = f'Updated {sum(update)} document chunks'
     else:
         response = f'Error updating index'
     await ctx.send(response)
 
 
-# Starts our bot with token
-bot.start(os.getenv("DISCORD_BOT_TOKEN"))
\ No newline at end of file
+# Starts our bot with token (only when run directly: the worker processes that read
+# documents for the index import this module too)
+if __name__ == "__main__":
+    # Exit normally on SIGTERM (e.g. docker stop, systemd) so the atexit handlers still save the caches
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    bot.start(os.getenv("DISCORD_BOT_TOKEN"))
\ No newline at end of file
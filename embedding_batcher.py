@@ -0,0 +1,72 @@
+import asyncio
+import logging
+
+
+class EmbeddingBatcher:
+    """
+    Coalesces concurrent embedding requests into a single API call.
+    A request waits at most `max_batch_hold` seconds for others to join it,
+    and a batch is sent early once `max_batch_size` requests are waiting.
+    """
+
+    def __init__(self, embed_batch, max_batch_size: int = 64, max_batch_hold: float = 0.01):
+        self.embed_batch = embed_batch  # async function: list of texts -> list of embeddings
+        self.max_batch_size = max_batch_size
+        self.max_batch_hold = max_batch_hold
+        self.queue = asyncio.Queue()
+        self._worker = None
+        self._in_flight = set()  # keep references so running batches aren't garbage collected
+
+    async def embed(self, text: str):
+        """
+        Embeds one text, sharing the API call with any other texts queued at the same time.
+        """
+        # Start the background worker on first use (needs a running event loop)
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._collect_batches())
+
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((text, future))
+        return await future
+
+    async def _collect_batches(self):
+        """
+        Background worker: drains the queue into batches and dispatches each one.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_batch_hold
+
+            # Hold the batch open briefly so concurrent requests can join it
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            task = asyncio.create_task(self._dispatch(batch))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _dispatch(self, batch):
+        """
+        Sends one batch to the embedding API and resolves each waiting request.
+        """
+        texts = [text for text, _ in batch]
+        try:
+            embeddings = await self.embed_batch(texts)
+        except Exception as e:
+            logging.error(f"Embedding batch of {len(texts)} failed: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        logging.info(f"Embedded batch of {len(texts)} texts.")
+        for (_, future), embedding in zip(batch, embeddings):
+            if not future.done():
+                future.set_result(embedding)
@@ -0,0 +1,206 @@
+from llama_index.embeddings import OpenAIEmbedding
+from embedding_batcher import EmbeddingBatcher
+import atexit
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+import numpy as np
+
+# Where embeddings are persisted between bot restarts (override with EMBEDDING_CACHE_PATH)
+DEFAULT_CACHE_PATH = ".embedding_cache.sqlite3"
+
+# Most embeddings kept on disk; the least recently used ones are dropped beyond this (~6 KB each).
+# Override with EMBEDDING_CACHE_MAX_ENTRIES
+DEFAULT_MAX_ENTRIES = 10000
+
+# Cache writes (new embeddings and last-used times) are buffered in memory and written in one
+# transaction once this many are pending, so a cache hit or miss doesn't cost a database write
+WRITE_BATCH_SIZE = 64
+
+# Texts per embeddings API request (the default of 10 means one round-trip per few chunks when building the index)
+EMBED_BATCH_SIZE = 100
+
+
+# Shared embedding client, so every caller reuses one pool of keep-alive connections.
+# Created on first use (after .env is loaded), never at import time
+_embed_model = None
+
+def get_embed_model():
+    """Helper to get the embedding model used by the index."""
+    global _embed_model
+    if _embed_model is None:
+        _embed_model = OpenAIEmbedding(embed_batch_size=EMBED_BATCH_SIZE)
+    return _embed_model
+
+
+class EmbeddingCache:
+    """
+    Table of md5(model:text) -> embedding in a small SQLite file, so new embeddings are row writes
+    instead of rewriting the whole cache. Holds at most `max_entries` embeddings, evicting the least recently used.
+    Writes are batched (see WRITE_BATCH_SIZE) and the rest go out on close().
+    The whole cache is dropped if the embedding model or dimension changes.
+    """
+
+    def __init__(self, path: str, model_name: str, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.dimensions = None
+        self._size = 0
+        self._db = None
+        self._new_rows = {}  # key -> (embedding blob, last used), not written yet
+        self._touched = {}  # key -> last used, for cached rows whose new time isn't written yet
+
+    def _key(self, text: str) -> str:
+        return hashlib.md5(f"{self.model_name}:{text}".encode()).hexdigest()
+
+    def load(self):
+        """
+        Opens the cache file, emptying it if it was built with another model.
+        """
+        # WAL + synchronous=NORMAL: a write is an append to the log, with no fsync per commit
+        self._db = sqlite3.connect(self.path, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, embedding BLOB, last_used REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+
+        meta = dict(self._db.execute("SELECT key, value FROM meta"))
+        if meta.get("model") != self.model_name:
+            if meta:
+                logging.info("Embedding model changed, discarding embedding cache.")
+            self._reset()
+        else:
+            self.dimensions = int(meta["dimensions"]) if meta.get("dimensions") else None
+        self._size = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        logging.info(f"Loaded {self._size} cached embeddings.")
+
+    def _reset(self, dimensions: int = None):
+        """Helper: deletes every embedding and records the current model (and dimension)."""
+        self._db.execute("DELETE FROM embeddings")
+        self._db.execute("INSERT OR REPLACE INTO meta VALUES ('model', ?)", (self.model_name,))
+        self._db.execute("INSERT OR REPLACE INTO meta VALUES ('dimensions', ?)", (dimensions and str(dimensions),))
+        self.dimensions = dimensions
+        self._size = 0
+        self._new_rows.clear()
+        self._touched.clear()
+
+    def close(self):
+        """Writes any pending changes and closes the cache file."""
+        if self._db is not None:
+            self.flush()
+            self._db.close()
+            self._db = None
+
+    def get(self, text: str):
+        """Returns the cached embedding for the text, or None."""
+        key = self._key(text)
+        pending = self._new_rows.get(key)
+        if pending is not None:
+            self._new_rows[key] = (pending[0], time.time())
+            return np.frombuffer(pending[0], dtype=np.float32).tolist()
+
+        row = self._db.execute("SELECT embedding FROM embeddings WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self._touched[key] = time.time()
+        self._flush_if_due()
+        return np.frombuffer(row[0], dtype=np.float32).tolist()
+
+    def put(self, text: str, embedding):
+        """
+        Stores an embedding, invalidating the cache if its dimension differs from the cached ones.
+        """
+        if self.dimensions != len(embedding):
+            if self._size:
+                logging.info("Embedding dimension changed, discarding embedding cache.")
+            self._reset(len(embedding))
+
+        key = self._key(text)
+        self._new_rows[key] = (np.asarray(embedding, dtype=np.float32).tobytes(), time.time())
+        self._touched.pop(key, None)
+        self._flush_if_due()
+
+    def _flush_if_due(self):
+        """Helper: writes the pending changes once there are WRITE_BATCH_SIZE of them."""
+        if len(self._new_rows) + len(self._touched) >= WRITE_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the pending embeddings and last-used times in one transaction, then evicts if over capacity.
+        """
+        if not self._new_rows and not self._touched:
+            return
+        new_rows, self._new_rows = self._new_rows, {}
+        touched, self._touched = self._touched, {}
+
+        with self._db:
+            self._db.execute("BEGIN")
+            # Replacing a key that's already cached (e.g. two concurrent misses for one text) doesn't add a row
+            keys = list(new_rows)
+            existing = self._db.execute(
+                f"SELECT COUNT(*) FROM embeddings WHERE key IN ({','.join('?' * len(keys))})", keys
+            ).fetchone()[0]
+            self._db.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+                [(key, blob, last_used) for key, (blob, last_used) in new_rows.items()],
+            )
+            self._db.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                [(last_used, key) for key, last_used in touched.items()],
+            )
+        self._size += len(keys) - existing
+
+        # Evict in batches of 10% so the DELETE doesn't run on every flush once the cache is full
+        if self._size > self.max_entries:
+            excess = self._size - self.max_entries + self.max_entries // 10
+            self._db.execute(
+                "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                (excess,),
+            )
+            self._size = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+
+# The on-disk cache and the batcher are created on first use, not at import:
+# the embedding client reads OPENAI_API_KEY (and the cache its settings) when it's built,
+# and .env may not be loaded yet at import time
+_cache = None
+_batcher = None
+
+def get_cache():
+    """Helper to get the on-disk embedding cache (opened on first use)."""
+    global _cache
+    if _cache is None:
+        _cache = EmbeddingCache(
+            os.getenv("EMBEDDING_CACHE_PATH", DEFAULT_CACHE_PATH),
+            get_embed_model().model_name,
+            int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", str(DEFAULT_MAX_ENTRIES))),
+        )
+        _cache.load()
+        atexit.register(_cache.close)
+    return _cache
+
+def get_batcher():
+    """Helper to get the batcher, so concurrent cache misses share one embedding API call."""
+    global _batcher
+    if _batcher is None:
+        _batcher = EmbeddingBatcher(get_embed_model().aget_text_embedding_batch)
+    return _batcher
+
+
+async def get_embedding(text: str):
+    """
+    Embeds text (e.g. a user's question), reusing the on-disk cache when possible.
+    """
+    cache = get_cache()
+    embedding = cache.get(text)
+    if embedding is None:
+        embedding = await get_batcher().embed(text)
+        cache.put(text, embedding)
+    return embedding
@@ -1,7 +1,15 @@
-from llama_index import SimpleDirectoryReader, VectorStoreIndex, load_index_from_storage
+from llama_index import SimpleDirectoryReader, VectorStoreIndex, ServiceContext, load_index_from_storage
 from llama_index.storage.storage_context import StorageContext
+from concurrent.futures import ProcessPoolExecutor
 from dotenv import load_dotenv
+from pathlib import Path
+from embedding_cache import get_embed_model
+import asyncio
+import hashlib
+import json
 import logging
+import multiprocessing
+import os
 import sys
 
 # Load environment variables from the .env file
@@ -11,78 +19,255 @@ load_dotenv()
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 logging.getLogger().addHandler(logging.StreamHandler(stream=sys.stdout))
 
+# The index, loaded once and shared by every query (replaced by update_index)
+_index = None
+_index_lock = asyncio.Lock()
+
+# Functions called (with no arguments) whenever the index is rebuilt or its documents change,
+# e.g. to drop answers cached from the old documents
+_index_listeners = []
+
+# Below this many files, reading them in worker processes costs more (starting the processes) than it saves
+PARALLEL_READ_MIN_FILES = 8
+
+# Content hash of every indexed file, so /updatedb only re-reads files that changed
+FILE_HASHES_PATH = "./storage/file_hashes.json"
+
+
+def load_file(path):
+    """
+    Helper: reads a single file into documents.
+    Module-level so it can be sent to worker processes.
+    """
+    return SimpleDirectoryReader(input_files=[path], filename_as_id=True).load_data()
+
+
+# Shared service context for building, refreshing and searching the index, created on first use
+_service_context = None
+
+def get_service_context():
+    """
+    Helper: service context that embeds with the shared, large-batch embedding model.
+    None of these steps call the LLM, so none is set (the default would create a new OpenAI client every time).
+    """
+    global _service_context
+    if _service_context is None:
+        _service_context = ServiceContext.from_defaults(llm=None, embed_model=get_embed_model())
+    return _service_context
+
+
+def read_stored_index():
+    """
+    Helper: loads the index persisted in ./storage (raises FileNotFoundError if there is none).
+    Reads and parses every stored JSON file, so callers run it in a worker thread.
+    """
+    storage_context = StorageContext.from_defaults(persist_dir="./storage")
+    return load_index_from_storage(storage_context, service_context=get_service_context())
+
+
+def list_files(directory_path: str):
+    """
+    Helper: the files in the directory that would be indexed, in name order (hidden files are skipped).
+    Uses os.scandir, whose entries already know whether they are files, so there's no extra stat per file.
+    """
+    with os.scandir(directory_path) as entries:
+        return sorted(Path(entry.path) for entry in entries if entry.is_file() and not entry.name.startswith("."))
+
+
+async def read_documents(files):
+    """
+    Reads the given docs (PDFs, text files) without blocking the event loop.
+    A handful of files is read in a worker thread; larger batches are spread over worker processes,
+    since PDF parsing is CPU-bound pure Python and only processes actually run it in parallel.
+    """
+    if len(files) < PARALLEL_READ_MIN_FILES:
+        per_file = await asyncio.to_thread(lambda: [load_file(path) for path in files])
+    else:
+        # Spawn (not fork) the workers: the bot has other threads running, which makes forking unsafe.
+        # Spawned workers re-import the bot's main module, which is why nothing there starts the bot,
+        # opens a cache or creates a client at import time
+        loop = asyncio.get_running_loop()
+        workers = min(os.cpu_count() or 1, len(files))
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            per_file = await asyncio.gather(*[loop.run_in_executor(executor, load_file, path) for path in files])
+
+    # Keep the reader's file order so document ids and chunk order don't change
+    return [document for documents in per_file for document in documents]
+
+
+def hash_files(files, known_hashes=None):
+    """
+    Helper: maps each file path to the sha256 of its contents (plus the size and mtime it was hashed at).
+    Files whose size and mtime match their entry in `known_hashes` aren't read again.
+    """
+    known_hashes = known_hashes or {}
+    hashes = {}
+    for path in files:
+        stat = os.stat(path)
+        known = known_hashes.get(str(path), {})
+        if known.get("mtime_ns") == stat.st_mtime_ns and known.get("size") == stat.st_size:
+            hashes[str(path)] = known
+            continue
+        with open(path, "rb") as f:
+            sha256 = hashlib.file_digest(f, "sha256").hexdigest()
+        hashes[str(path)] = {"sha256": sha256, "mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+    return hashes
+
+
+def load_file_hashes():
+    """
+    Helper: file hashes recorded at the last index build/update ({} if there are none).
+    """
+    try:
+        with open(FILE_HASHES_PATH, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_file_hashes(hashes):
+    """
+    Helper: records the file hashes next to the persisted index (atomically).
+    """
+    tmp_path = f"{FILE_HASHES_PATH}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(hashes, f)
+    os.replace(tmp_path, FILE_HASHES_PATH)
+
+
+def on_index_change(callback):
+    """
+    Registers a function to call whenever the index is rebuilt or its documents change.
+    Returns the function, so it can be used as a decorator.
+    """
+    _index_listeners.append(callback)
+    return callback
+
+
+def notify_index_change():
+    """
+    Helper: calls every function registered with on_index_change().
+    """
+    for callback in _index_listeners:
+        callback()
+
 
 async def load_index(directory_path: str = r'data'):
     """
     Main function to initialize the knowledge base.
-    1. Reads files from the 'data' folder.
+    1. Returns the index already in memory, if there is one.
     2. Checks if a processed index already exists in 'storage'.
-    3. If yes, loads it (fast). If no, creates a new one (slower, costs API credits).
+    3. If yes, loads it (fast). If no, reads the files from the 'data' folder
+       and creates a new one (slower, costs API credits).
     """
-    
-    # Read all docs (PDFs, text files) from directory
-    documents = SimpleDirectoryReader(directory_path, filename_as_id=True).load_data()
-    print(f"loaded documents with {len(documents)} pages")
+    global _index
+    if _index is not None:
+        return _index
 
-    try:
-        # Try to find an existing index on the disk (in the ./storage folder)
-        storage_context = StorageContext.from_defaults(persist_dir="./storage")
-        
-        # Load the index (this avoids re-sending data to OpenAI if it was already done)
-        index = load_index_from_storage(storage_context)
-        logging.info("Index loaded from storage.")
-        
-    except FileNotFoundError:
-        # If storage directory/files don't exist, build a new index 
-        logging.info("Index not found. Creating a new one...")
-        
-        # Vectorise our raw documents
-        index = VectorStoreIndex.from_documents(documents)
-        
-        # Save our new index to the hard drive for future use
-        index.storage_context.persist()
-        logging.info("New index created and persisted to storage.")
-
-    return index
+    # Only one caller loads/builds the index; the rest wait and reuse it
+    async with _index_lock:
+        if _index is not None:
+            return _index
+
+        try:
+            # Try to find an existing index on the disk (in the ./storage folder) and load it
+            # (this avoids re-sending data to OpenAI if it was already done)
+            index = await asyncio.to_thread(read_stored_index)
+            logging.info("Index loaded from storage.")
+
+        except FileNotFoundError:
+            # If storage directory/files don't exist, build a new index
+            logging.info("Index not found. Creating a new one...")
+
+            # Read all docs (PDFs, text files) from directory.
+            # Hash them first: a file edited while the index is built then looks changed to the next /updatedb
+            files = list_files(directory_path)
+            hashes = await asyncio.to_thread(hash_files, files)
+            documents = await read_documents(files)
+            print(f"loaded documents with {len(documents)} pages")
+
+            # Vectorise our raw documents (chunking and embedding block, so keep them off the event loop)
+            index = await asyncio.to_thread(
+                VectorStoreIndex.from_documents, documents, service_context=get_service_context()
+            )
+
+            # Save our new index to the hard drive for future use
+            await asyncio.to_thread(index.storage_context.persist)
+            save_file_hashes(hashes)
+            logging.info("New index created and persisted to storage.")
+
+            # Anything cached from a previous index is stale
+            notify_index_change()
+
+        _index = index
+        return index
 
 
 async def update_index(directory_path: str = r'data'):
     """
     Smart update function triggered by /updatedb.
     It compares the current files in 'data' vs the saved index.
-    It ONLY updates files that are new or changed, saving time and money.
+    It ONLY reads and updates files that are new or changed, and drops files that were removed,
+    saving time and money.
     """
-    try:
-        # Read the current files in the directory
-        documents = SimpleDirectoryReader(directory_path, filename_as_id=True).load_data()
-    except FileNotFoundError:
-        # Case where dir is invalid
-        logging.error("Invalid document directory path.")
-        return None
+    global _index
+    # Hold the lock throughout, so a concurrent load_index/update_index never sees a half-updated index
+    # (or builds/refreshes it a second time)
+    async with _index_lock:
+        try:
+            # Find the current files in the directory and hash their contents
+            # (only files modified since the last update are actually read)
+            files = list_files(directory_path)
+            old_hashes = load_file_hashes()
+            hashes = await asyncio.to_thread(hash_files, files, old_hashes)
+        except FileNotFoundError:
+            # Case where dir is invalid
+            logging.error("Invalid document directory path.")
+            return None
 
-    try:
-        # Load the existing index so we can compare against it
-        storage_context = StorageContext.from_defaults(persist_dir="./storage")
-        index = load_index_from_storage(storage_context)
-        logging.info("Existing index loaded from storage.")
-
-        # Refresh the index
-        refreshed_docs = index.refresh_ref_docs(
-            documents, 
-            update_kwargs={"delete_kwargs": {"delete_from_docstore": True}}
-        )
-
-        # Print updated doc results
-        print(refreshed_docs)
-        print('Number of newly inserted/refreshed docs: ', sum(refreshed_docs))
-
-        # Save the updated index back to disk
-        index.storage_context.persist()
-        logging.info("Index refreshed and persisted to storage.")
-        
-        return refreshed_docs
-
-    except FileNotFoundError:
-        # Case where an index is updated before it exists
-        logging.error("Index is not created yet. Please run a query first to generate the initial index.")
-        return None
\ No newline at end of file
+        try:
+            # Load the existing index so we can compare against it
+            index = await asyncio.to_thread(read_stored_index)
+            logging.info("Existing index loaded from storage.")
+
+            # Only files whose contents changed since the last update need to be read again
+            changed_files = [
+                path for path in files
+                if old_hashes.get(str(path), {}).get("sha256") != hashes[str(path)]["sha256"]
+            ]
+            documents = await read_documents(changed_files)
+            print(f"{len(changed_files)} of {len(files)} files changed")
+
+            # Refresh the index (changed docs are already deleted from the docstore before being re-inserted).
+            # Re-chunking and re-embedding block, so run them in a worker thread
+            refreshed_docs = await asyncio.to_thread(index.refresh_ref_docs, documents)
+
+            # Drop docs that no longer exist: every doc of a removed file, and e.g. pages cut from a changed PDF
+            changed_paths = {str(path) for path in changed_files}
+            current_ids = {document.id_ for document in documents}
+            for doc_id, info in index.ref_doc_info.items():
+                path = info.metadata.get("file_path")
+                if (path not in hashes or path in changed_paths) and doc_id not in current_ids:
+                    index.delete_ref_doc(doc_id, delete_from_docstore=True)
+                    refreshed_docs.append(True)
+
+            # Print updated doc results
+            print(refreshed_docs)
+            print('Number of newly inserted/refreshed/removed docs: ', sum(refreshed_docs))
+
+            # Save the updated index back to disk
+            await asyncio.to_thread(index.storage_context.persist)
+            save_file_hashes(hashes)
+            logging.info("Index refreshed and persisted to storage.")
+
+            # Serve queries from the updated index from now on
+            _index = index
+            if any(refreshed_docs):
+                notify_index_change()
+
+            return refreshed_docs
+
+        except FileNotFoundError:
+            # Case where an index is updated before it exists
+            logging.error("Index is not created yet. Please run a query first to generate the initial index.")
+            return None
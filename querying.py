@@ -1,6 +1,14 @@
-from manage_embedding import load_index
+from manage_embedding import load_index, on_index_change
 from llama_index import ServiceContext
-from llama_index.llms import OpenAI
+from llama_index.llms import OpenAI, ChatMessage, MessageRole
+from llama_index import QueryBundle
+from embedding_cache import get_embedding, get_embed_model
+from rate_limiter import OpenAIRateLimiter, estimate_tokens
+from llama_index.prompts import ChatPromptTemplate
+from llama_index.prompts.chat_prompts import TEXT_QA_SYSTEM_PROMPT, TEXT_QA_PROMPT_TMPL_MSGS
+from llama_index.schema import MetadataMode
+from collections import OrderedDict
+import asyncio
 import logging
 import sys
 import os
@@ -9,50 +17,199 @@ import os
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 logging.getLogger().addHandler(logging.StreamHandler(stream=sys.stdout))
 
+# Pace OpenAI calls to the account limits (set these to match your OpenAI tier)
+limiter = OpenAIRateLimiter(
+    rpm=int(os.getenv("OPENAI_RPM_LIMIT", "500")),
+    tpm=int(os.getenv("OPENAI_TPM_LIMIT", "60000")),
+)
+
+# Most LLM calls in flight at once; extra /ask and /quiz requests wait their turn
+# instead of all piling onto the OpenAI connection pool (and the rate limiter) at the same time
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+llm_slots = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+
+# Rough token cost of a RAG call on top of the question: retrieved chunks (2 x 1024 by default) plus the answer
+RAG_OVERHEAD_TOKENS = 2 * 1024 + 512
+
+# Small LRU cache for the /ask pipeline (cleared by reset_caches() when the index changes):
+# sorted tuple of node ids -> assembled context block.
+# (Retrieval results aren't cached: a repeated question is already answered by the bot's semantic cache)
+QUERY_CACHE_SIZE = 256
+context_cache = OrderedDict()
+
+def remember(cache: OrderedDict, key, value):
+    """Helper: stores a value in an LRU cache like the one above, evicting the oldest entry if full."""
+    cache[key] = value
+    cache.move_to_end(key)
+    if len(cache) > QUERY_CACHE_SIZE:
+        cache.popitem(last=False)
+
+@on_index_change
+def reset_caches():
+    """Clears the context cache (called whenever the index changes)."""
+    context_cache.clear()
+
+# Shared OpenAI client, created once by warm_up() (or on first use)
+_llm = None
+
 def get_llm():
     """Helper to get the configured OpenAI model."""
-    return OpenAI(model=os.getenv("OPENAI_MODEL_NAME", "gpt-3.5-turbo"))   # cheap model for testing. can change if you like
+    global _llm
+    if _llm is None:
+        _llm = OpenAI(model=os.getenv("OPENAI_MODEL_NAME", "gpt-3.5-turbo"))   # cheap model for testing. can change if you like
+    return _llm
+
+# Service context for /quiz's query engine (the index's own one has no LLM), created on first use
+_quiz_service_context = None
+
+def get_quiz_service_context():
+    """Helper to get a service context with the shared LLM and embedding model."""
+    global _quiz_service_context
+    if _quiz_service_context is None:
+        _quiz_service_context = ServiceContext.from_defaults(llm=get_llm(), embed_model=get_embed_model())
+    return _quiz_service_context
 
-async def data_querying(input_text: str):
+# /quiz's query engine and the index it was built on (rebuilt when /updatedb swaps in a new index)
+_quiz_engine = None
+_quiz_engine_index = None
+
+def get_quiz_engine(index):
+    """Helper to get the /quiz query engine for the given index, reusing it while the index stays the same."""
+    global _quiz_engine, _quiz_engine_index
+    if _quiz_engine is None or _quiz_engine_index is not index:
+        _quiz_engine = index.as_query_engine(service_context=get_quiz_service_context())
+        _quiz_engine_index = index
+    return _quiz_engine
+
+async def warm_up():
+    """
+    Creates the OpenAI client, loads (or builds) the index and sets up /quiz's query engine at startup,
+    so slash commands never pay for this before their first response.
+    """
+    get_quiz_engine(await load_index("data"))
+
+async def retrieve_context(input_text: str):
     """
-    Takes a user's question (input_text), searches the knowledge base,
-    and returns an AI-generated answer.
+    Searches the knowledge base for a user's question (input_text)
+    and returns the relevant chunks as a single context block.
     """
     # Load the Knowledge Base
     index = await load_index("data")
-    
-    # Configure the LLM
+
+    # Embed the question through the cache so the retriever doesn't re-embed it
+    query_embedding = await get_embedding(input_text)
+
+    # Retrieve the most relevant chunks
+    nodes = await index.as_retriever().aretrieve(QueryBundle(input_text, embedding=query_embedding))
+
+    # Assemble the context in a fixed (node id) order, so the same chunks always give a
+    # byte-identical prompt prefix that OpenAI's prompt caching can reuse
+    doc_ids = tuple(sorted(n.node.node_id for n in nodes))
+    context = context_cache.get(doc_ids)
+    if context is None:
+        nodes_by_id = {n.node.node_id: n.node for n in nodes}
+        context = "\n\n".join(nodes_by_id[i].get_content(metadata_mode=MetadataMode.LLM) for i in doc_ids)
+        remember(context_cache, doc_ids, context)
+
+    return context
+
+# The /ask prompt: llama-index's default Q&A chat prompt with the academic integrity check folded
+# into its (fixed) system message, so one LLM call both screens and answers the question
+VIOLATION_TAG = "VIOLATION"
+GUARDED_QA_PROMPT = ChatPromptTemplate(
+    message_templates=[
+        ChatMessage(
+            role=MessageRole.SYSTEM,
+            content=(
+                TEXT_QA_SYSTEM_PROMPT.content + "\n"
+                "3. You are also an academic integrity filter for an educational bot. "
+                "If the query explicitly asks to generate a full essay, write code without explanation, "
+                "or complete an assignment for the user, do not answer it: reply starting with 'VIOLATION:' "
+                "followed by a gentle refusal and a suggestion to guide them instead "
+                "(e.g. 'I can't write the essay, but I can help outline it'). "
+                "Otherwise, just answer the query."
+            ),
+        ),
+        *TEXT_QA_PROMPT_TMPL_MSGS[1:],
+    ]
+)
+
+def parse_guarded_answer(text: str):
+    """
+    Splits a reply to GUARDED_QA_PROMPT into (is_safe: bool, answer or refusal message: str).
+    """
+    text = text.strip()
+    if text.startswith(VIOLATION_TAG):
+        # Return False (unsafe) and the explanation (removing the tag)
+        return False, text.replace(f"{VIOLATION_TAG}:", "").strip()
+    return True, text
+
+def may_be_refusal(partial_text: str) -> bool:
+    """
+    True if a partly streamed reply to GUARDED_QA_PROMPT is (or could still become) a refusal,
+    i.e. it shouldn't be shown to the user yet.
+    """
+    start = partial_text.lstrip()[:len(VIOLATION_TAG)]
+    return VIOLATION_TAG.startswith(start)
+
+async def data_querying_stream(input_text: str, context: str = None):
+    """
+    Takes a user's question (input_text), searches the knowledge base, and streams an AI-generated answer,
+    checking for academic integrity in the same LLM call: yields the raw reply piece by piece as the LLM generates it.
+    Pass the full reply to parse_guarded_answer() once it's done (and use may_be_refusal() before showing partial replies).
+    Pass `context` if retrieve_context() was already run for this question.
+    """
+    if context is None:
+        context = await retrieve_context(input_text)
+
     llm = get_llm()
-    service_context = ServiceContext.from_defaults(llm=llm)
-    
-    # Query Engine
-    engine = index.as_query_engine(service_context=service_context)
-    response = engine.query(input_text)
 
-    response_text = response.response
-    logging.info(response_text)
+    async def start_stream():
+        # astream() only builds the generator: the HTTP request (and any 429) happens on the first
+        # iteration, so that has to run inside limiter.call to get its backoff
+        tokens = await llm.astream(GUARDED_QA_PROMPT, context_str=context, query_str=input_text)
+        return tokens, await anext(tokens, None)
 
-    return response_text
+    # Hold the slot until the whole answer has streamed in
+    async with llm_slots:
+        tokens, first = await limiter.call(start_stream, estimate_tokens(context + input_text) + 512)
+        if first is not None:
+            yield first
+        async for delta in tokens:
+            yield delta
+
+# Fixed instructions for the academic integrity check, sent as a prebuilt system message.
+# Only the user's query changes between calls, so every request shares the same prompt prefix
+# (which OpenAI can cache server-side) and the message objects aren't rebuilt per call
+ACADEMIC_INTEGRITY_MESSAGES = (
+    ChatMessage(
+        role=MessageRole.SYSTEM,
+        content=(
+            "You are an academic integrity filter for an educational bot. "
+            "Analyze the user's query. "
+            "Does it explicitly ask to generate a full essay, write code without explanation, "
+            "or complete an assignment for the user? "
+            "If YES (violation), reply starting with 'VIOLATION:' followed by a gentle refusal "
+            "and a suggestion to guide them instead (e.g. 'I can't write the essay, but I can help outline it'). "
+            "If NO (safe), reply with 'SAFE'."
+        ),
+    ),
+)
 
 async def detect_academic_dishonesty(input_text: str):
     """
     Checks if the user is asking the bot to cheat (write an assignment for them).
     Returns (is_safe: bool, response_message: str).
+    (/ask doesn't call this any more: data_querying_stream's prompt does the same check while answering.)
     """
     llm = get_llm()
-    prompt = (
-        "You are an academic integrity filter for an educational bot. "
-        f"Analyze this query: '{input_text}'. "
-        "Does it explicitly ask to generate a full essay, write code without explanation, "
-        "or complete an assignment for the user? "
-        "If YES (violation), reply starting with 'VIOLATION:' followed by a gentle refusal "
-        "and a suggestion to guide them instead (e.g. 'I can't write the essay, but I can help outline it'). "
-        "If NO (safe), reply with 'SAFE'."
-    )
+    messages = ACADEMIC_INTEGRITY_MESSAGES + (ChatMessage(role=MessageRole.USER, content=input_text),)
     
-    # Use complete() for direct text generation without context
-    response = await llm.acomplete(prompt)
-    text = response.text.strip()
+    # Use chat() for direct text generation without context
+    estimated_tokens = estimate_tokens(ACADEMIC_INTEGRITY_MESSAGES[0].content + input_text) + 100
+    async with llm_slots:
+        response = await limiter.call(lambda: llm.achat(messages), estimated_tokens)
+    text = (response.message.content or "").strip()
     
     if text.startswith("VIOLATION"):
         # Return False (unsafe) and the explanation (removing the tag)
@@ -65,9 +222,7 @@ async def generate_quiz(topic: str):
     Generates a 3-question multiple choice quiz on the given topic using the RAG index.
     """
     index = await load_index("data")
-    llm = get_llm()
-    service_context = ServiceContext.from_defaults(llm=llm)
-    engine = index.as_query_engine(service_context=service_context)
+    engine = get_quiz_engine(index)
     
     prompt = (
         f"Generate a 3-question multiple choice quiz about '{topic}' based on the available context. "
@@ -80,5 +235,6 @@ async def generate_quiz(topic: str):
         "Repeat for Q2 and Q3."
     )
     
-    response = engine.query(prompt)
+    async with llm_slots:
+        response = await limiter.call(lambda: engine.aquery(prompt), estimate_tokens(prompt) + RAG_OVERHEAD_TOKENS)
     return response.response
\ No newline at end of file
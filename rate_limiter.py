@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import random
+import time
+import openai
+
+
+class OpenAIRateLimiter:
+    """
+    Token-bucket throttle over requests per minute (RPM) and tokens per minute (TPM).
+    Calls wait until both buckets have capacity, so we dispatch right up to the
+    account limits instead of hitting them and retrying.
+    After a 429 the buckets shrink, then grow back to the configured limits once the 429s stop.
+    """
+
+    # A burst of 429s (e.g. every call in flight failing at once) only shrinks the buckets once
+    RATE_LIMIT_BURST_WINDOW = 10
+    # Each quiet RECOVERY_INTERVAL seconds (no 429s) gives back RECOVERY_STEP of the configured limits
+    RECOVERY_INTERVAL = 30
+    RECOVERY_STEP = 0.1
+    # The buckets never shrink below this fraction of the configured limits
+    MIN_FRACTION = 0.1
+
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_requests = rpm
+        self.max_tokens = tpm
+        self.available_request_capacity = rpm
+        self.available_token_capacity = tpm
+        self._last_update = time.monotonic()
+        self._last_rate_limit = None  # last 429 (or last recovery step since then)
+        self._last_shrink = None
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        """
+        Helper: tops up both buckets by rpm/60 and tpm/60 per second elapsed,
+        first letting the limits recover if there have been no 429s for a while.
+        """
+        now = time.monotonic()
+        if self._last_rate_limit is not None and now - self._last_rate_limit >= self.RECOVERY_INTERVAL:
+            steps = int((now - self._last_rate_limit) // self.RECOVERY_INTERVAL)
+            self.max_requests = min(self.rpm, self.max_requests + self.rpm * self.RECOVERY_STEP * steps)
+            self.max_tokens = min(self.tpm, self.max_tokens + self.tpm * self.RECOVERY_STEP * steps)
+            if self.max_requests >= self.rpm and self.max_tokens >= self.tpm:
+                self._last_rate_limit = None
+                logging.info("OpenAI rate limits recovered to the configured limits.")
+            else:
+                self._last_rate_limit += steps * self.RECOVERY_INTERVAL
+
+        elapsed = now - self._last_update
+        self._last_update = now
+        self.available_request_capacity = min(
+            self.max_requests, self.available_request_capacity + self.max_requests * elapsed / 60
+        )
+        self.available_token_capacity = min(
+            self.max_tokens, self.available_token_capacity + self.max_tokens * elapsed / 60
+        )
+
+    async def acquire(self, estimated_tokens: int):
+        """
+        Waits until there is capacity for one request using `estimated_tokens` tokens, then takes it.
+        """
+        # Waiters queue on the lock so capacity is handed out in arrival order
+        async with self._lock:
+            while True:
+                self._refill()
+                # A single request larger than the whole bucket could never be served otherwise.
+                # Capped here, not on entry: a 429 can shrink the bucket while this caller waits
+                tokens = min(estimated_tokens, self.max_tokens)
+                if self.available_request_capacity >= 1 and self.available_token_capacity >= tokens:
+                    self.available_request_capacity -= 1
+                    self.available_token_capacity -= tokens
+                    return
+
+                # Sleep just long enough for the emptier bucket to refill
+                request_wait = (1 - self.available_request_capacity) * 60 / self.max_requests
+                token_wait = (tokens - self.available_token_capacity) * 60 / self.max_tokens
+                await asyncio.sleep(max(request_wait, token_wait, 0.01))
+
+    def on_rate_limit(self):
+        """
+        Shrinks both buckets by 10% after a 429, since the real limits are lower than configured.
+        Only the first 429 of a burst shrinks them; every 429 restarts the recovery timer.
+        """
+        now = time.monotonic()
+        self._last_rate_limit = now
+        if self._last_shrink is not None and now - self._last_shrink < self.RATE_LIMIT_BURST_WINDOW:
+            return
+        self._last_shrink = now
+
+        self.max_requests = max(self.rpm * self.MIN_FRACTION, self.max_requests * 0.9)
+        self.max_tokens = max(self.tpm * self.MIN_FRACTION, self.max_tokens * 0.9)
+        self.available_request_capacity = min(self.available_request_capacity, self.max_requests)
+        self.available_token_capacity = min(self.available_token_capacity, self.max_tokens)
+        logging.warning(f"OpenAI rate limit hit, throttling to {self.max_requests:.0f} RPM / {self.max_tokens:.0f} TPM.")
+
+    async def call(self, fn, estimated_tokens: int, max_attempts: int = 5, max_backoff: float = 30):
+        """
+        Awaits fn() once capacity is available.
+        On a RateLimitError, shrinks the buckets and retries with exponential backoff.
+        The wait is random in [0, min(2^attempt, max_backoff)] seconds, so a burst of
+        rate-limited calls doesn't retry in lockstep and hit the limit again together.
+        """
+        for attempt in range(max_attempts):
+            await self.acquire(estimated_tokens)
+            try:
+                return await fn()
+            except openai.RateLimitError:
+                if attempt == max_attempts - 1:
+                    raise
+                self.on_rate_limit()
+                await asyncio.sleep(random.uniform(0, min(2 ** (attempt + 1), max_backoff)))
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count for English text (~4 characters per token)."""
+    return len(text) // 4
@@ -0,0 +1,195 @@
+from collections import OrderedDict
+import asyncio
+import json
+import logging
+import os
+import numpy as np
+
+
+class SemanticCache:
+    """
+    Two-tier LRU cache placed in front of the RAG pipeline.
+    1. Exact match on the raw question string.
+    2. Approximate match: a cached answer is reused if the cosine similarity
+       between the question embeddings is at least `threshold`.
+    If `path` is given, the cache is loaded from (on first use) and saved to that JSON file so it survives restarts.
+    """
+
+    def __init__(self, embed, capacity: int = 512, threshold: float = 0.95, path: str = None):
+        self.embed = embed  # async function: text -> embedding
+        self.capacity = capacity
+        self.threshold = threshold
+        self.path = path
+
+        # question -> row in the arrays below, least recently used first
+        self.rows = OrderedDict()
+
+        # One row per cached question. Embeddings live in a single (capacity, dim) matrix,
+        # allocated on first insert, so a lookup is one matrix-vector product.
+        # They are stored as float16: half the memory, and the cosine error (~1e-3) is far below any useful threshold
+        self._embeddings = None
+        self._questions = [None] * capacity
+        self._answers = [None] * capacity
+        self._size = 0  # rows [0, _size) are in use
+        self._loaded = path is None
+        self.unsaved = False  # changed since the last save
+
+    async def lookup(self, query: str):
+        """
+        Looks up an answer for the query.
+        Returns (answer, embedding) - answer is None on a miss, embedding is None on an exact hit.
+        """
+        self._ensure_loaded()
+
+        # Exact hit: no embedding needed
+        row = self.rows.get(query)
+        if row is not None:
+            self.rows.move_to_end(query)
+            logging.info("Semantic cache: exact hit.")
+            return self._answers[row], None
+
+        embedding = np.asarray(await self.embed(query), dtype=np.float32)
+        embedding /= np.linalg.norm(embedding)
+
+        # Answers loaded from disk may have been embedded by a different model
+        if self._embeddings is not None and self._embeddings.shape[1] != len(embedding):
+            logging.info("Embedding dimension changed, discarding semantic cache.")
+            self.clear()
+
+        if self._size:
+            # Embeddings are normalised, so the dot product is the cosine similarity
+            scores = self._embeddings[:self._size].astype(np.float32) @ embedding
+            best = int(scores.argmax())
+            if scores[best] >= self.threshold:
+                self.rows.move_to_end(self._questions[best])
+                logging.info(f"Semantic cache: approximate hit (similarity {scores[best]:.3f}).")
+                return self._answers[best], embedding
+
+        return None, embedding
+
+    def insert(self, query: str, embedding, answer):
+        """
+        Stores an answer, reusing the least recently used row if the cache is full.
+        """
+        if embedding is None:
+            return
+        self._ensure_loaded()
+
+        if query in self.rows:
+            row = self.rows[query]
+        elif self._size < self.capacity:
+            row = self._size
+            self._size += 1
+        else:
+            _, row = self.rows.popitem(last=False)
+
+        if self._embeddings is None:
+            self._embeddings = np.empty((self.capacity, len(embedding)), dtype=np.float16)
+
+        self._embeddings[row] = embedding
+        self._questions[row] = query
+        self._answers[row] = answer
+        self.rows[query] = row
+        self.rows.move_to_end(query)
+        self.unsaved = True
+
+    async def get_or_compute(self, query: str, compute):
+        """
+        Returns the cached answer for the query, or awaits compute() and caches its result.
+        """
+        answer, embedding = await self.lookup(query)
+        if answer is not None:
+            return answer
+
+        answer = await compute()
+        self.insert(query, embedding, answer)
+        return answer
+
+    def clear(self):
+        """
+        Drops every cached answer (e.g. after the knowledge base changes).
+        """
+        self._loaded = True  # what's on disk is stale too
+        self.rows.clear()
+        self._embeddings = None
+        self._questions = [None] * self.capacity
+        self._answers = [None] * self.capacity
+        self._size = 0
+        self.unsaved = True
+
+    def _ensure_loaded(self):
+        """
+        Helper: loads the saved cache the first time it's needed (not at construction,
+        so importing the bot, e.g. in a worker process, doesn't read it).
+        """
+        if not self._loaded:
+            self._loaded = True
+            self.load()
+
+    def load(self):
+        """
+        Loads cached answers from `path`, oldest first so the LRU order is kept.
+        """
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.error(f"Could not read semantic cache {self.path}: {e}")
+            return
+
+        try:
+            for query, embedding, answer in zip(data["questions"], data["embeddings"], data["answers"]):
+                self.insert(query, np.asarray(embedding, dtype=np.float32), answer)
+        except (KeyError, ValueError) as e:
+            # e.g. the embedding model (and so the dimension) changed since it was saved
+            logging.info(f"Discarding semantic cache {self.path}: {e}")
+            self.clear()
+            return
+        self.unsaved = False
+        logging.info(f"Loaded {self._size} cached answers from {self.path}.")
+
+    def save(self):
+        """
+        Writes the cache to `path` atomically (write to a temp file, then rename), if it changed.
+        """
+        if self.path is None or not self.unsaved:
+            return
+        self.unsaved = False
+        self._write(self._snapshot())
+
+    async def save_in_background(self):
+        """
+        Same as save(), but writes the file in a worker thread.
+        The snapshot is taken first (on the calling thread), so lookups and inserts can carry on meanwhile.
+        """
+        if self.path is None or not self.unsaved:
+            return
+        self.unsaved = False
+        try:
+            await asyncio.to_thread(self._write, self._snapshot())
+        except Exception:
+            self.unsaved = True  # try again next time
+            raise
+
+    def _snapshot(self):
+        """
+        Helper: copies the cache's contents, least recently used first.
+        """
+        order = list(self.rows.items())
+        return {
+            "questions": [query for query, _ in order],
+            "answers": [self._answers[row] for _, row in order],
+            "embeddings": self._embeddings[[row for _, row in order]] if order else [],
+        }
+
+    def _write(self, data):
+        """
+        Helper: writes a snapshot to `path` atomically.
+        """
+        data["embeddings"] = [embedding.tolist() for embedding in data["embeddings"]]
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)